@@ -22,68 +22,110 @@ We split each ERT block into separate "layout blocks" (\begin_layout Plain Layou
 
 Usage:
   ./insert_tikz_lyx_debug.py mydoc.lyx --start-index 1 --prefix qcpict
+  ./insert_tikz_lyx_debug.py mydoc.lyx --yes   # no confirmation prompt
+  ./insert_tikz_lyx_debug.py mydoc.lyx --debug # per-block trace output
+  ./insert_tikz_lyx_debug.py chapters/*.lyx --yes  # files run in parallel
 """
 
 import re
 import argparse
+import contextlib
+import io
+import os
+import shutil
 import sys
-from typing import List, Tuple
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Pattern, Tuple
 
 ##############################################################################
 # Regex Patterns
 ##############################################################################
 
-ENV_LINE_RE = re.compile(
-    # Matches a line that has \backslash\n begin{tikzpicture} or \backslash\n begin{quantikz}.
-    # Possibly with bracket [stuff], on the same line.
-    # We'll do a simple search in each layout block text.
-    r'\\backslash\s*\n?\s*begin\{(tikzpicture|quantikz)\}'
+# Matches \backslash\n tikzsetnextfilename{...}, allowing multiple
+# newlines/spaces after \backslash. A single \s* run already covers newlines;
+# nesting it in (?:\n\s*)* only invites backtracking.
+TIKZSET_RE = re.compile(
+    r'\\backslash\s*tikzsetnextfilename\{([^}]+)\}'
 )
 
-# MODIFIED: allow multiple newlines/spaces after \backslash
-# and before 'tikzsetnextfilename'. Also use DOTALL for safety.
-TIKZSET_RE = re.compile(
-    r'\\backslash\s*(?:\n\s*)*tikzsetnextfilename\{([^}]+)\}',
-    re.DOTALL
+# The environments we number. These are found with plain str.find, see
+# find_environments().
+ENV_NAMES = ("begin{tikzpicture}", "begin{quantikz}")
+
+# One "\begin_layout Plain Layout" ... "\end_layout" block inside an ERT,
+# from the start of the opening line through the end of the closing line.
+LAYOUT_RE = re.compile(
+    r'^\\begin_layout Plain Layout.*?^\\end_layout[^\n]*\n?',
+    re.MULTILINE | re.DOTALL
 )
 
 ##############################################################################
 # Arg parsing
 ##############################################################################
 
-def parse_arguments():
+def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Insert layout blocks with "
                                      "tikzsetnextfilename commands inside ERT blocks.")
-    parser.add_argument("file", help="Path to the .lyx file.")
+    parser.add_argument("file", nargs="+", help="Path(s) to the .lyx file(s).")
     parser.add_argument("--start-index", "-s", type=int, default=1,
                         help="Start numbering from this integer (default=1).")
     parser.add_argument("--prefix", "-p", default="qcpict",
                         help="Filename prefix (default='qcpict').")
+    parser.add_argument("--yes", "-y", action="store_true",
+                        help="Do not ask for confirmation before writing.")
+    parser.add_argument("--debug", action="store_true",
+                        help="Print per-block [DEBUG] trace output.")
     return parser.parse_args()
 
 
+def debug_print(fmt: str, *args: object) -> None:
+    """Print a [DEBUG] line; formatting happens only here."""
+    print(fmt % args)
+
+
+def no_debug(fmt: str, *args: object) -> None:
+    """Stand-in for debug_print() when --debug is off: skips the formatting."""
+
+
 ##############################################################################
 # Step 1) Identify ERT blocks in the file
 ##############################################################################
 
-def find_ert_blocks(lines: List[str]) -> List[Tuple[int,int]]:
+def find_line_start(data: str, marker: str, pos: int) -> int:
+    """
+    Return the offset of the first occurrence of marker at or after pos that
+    sits at the start of a line, or -1.
+    """
+    i = data.find(marker, pos)
+    while i > 0 and data[i - 1] != "\n":
+        i = data.find(marker, i + 1)
+    return i
+
+
+def find_ert_blocks(data: str) -> List[Tuple[int,int]]:
     """
     Find all ERT blocks delimited by:
       \begin_inset ERT
       ...
       \end_inset
-    Returns list of (start_idx, end_idx) inclusive.
+    Returns list of (start, end) character offsets into data, from the start
+    of the opening line up to and including the newline of the closing line.
+
+    LyX never indents these markers, so we only look at line starts.
     """
     ert_blocks = []
-    inside = False
-    start_i = -1
-    for i, line in enumerate(lines):
-        if not inside and "\\begin_inset ERT" in line:
-            inside = True
-            start_i = i
-        elif inside and "\\end_inset" in line:
-            ert_blocks.append((start_i, i))
-            inside = False
+    pos = 0
+    while True:
+        start = find_line_start(data, "\\begin_inset ERT", pos)
+        if start == -1:
+            break
+        end = find_line_start(data, "\\end_inset", start)
+        if end == -1:
+            break
+        nl = data.find("\n", end)
+        pos = len(data) if nl == -1 else nl + 1
+        ert_blocks.append((start, pos))
     return ert_blocks
 
 
@@ -91,7 +133,7 @@ def find_ert_blocks(lines: List[str]) -> List[Tuple[int,int]]:
 # Step 2) Inside each ERT, we split text into layout blocks
 ##############################################################################
 
-def split_into_layout_blocks(ert_block_lines: List[str]) -> List[List[str]]:
+def split_into_layout_spans(ert_text: str) -> List[Tuple[int, int]]:
     """
     Within an ERT block, we typically see something like:
       \begin_layout Plain Layout
@@ -100,218 +142,333 @@ def split_into_layout_blocks(ert_block_lines: List[str]) -> List[List[str]]:
       \begin_layout Plain Layout
         ...
       \end_layout
-    We'll split these into separate lists of lines.
+    We'll split these into separate (start, end) character spans of ert_text.
 
     If there's text outside \begin_layout ... \end_layout pairs, 
     that becomes its own block as well.
     """
-    blocks: List[List[str]] = []
-    current: List[str] = []
-    in_layout = False
-
-    for line in ert_block_lines:
-        if "\\begin_layout Plain Layout" in line:
-            # Start of a new layout block
-            if current:
-                blocks.append(current)
-            current = [line]
-            in_layout = True
-        elif "\\end_layout" in line and in_layout:
-            current.append(line)
-            blocks.append(current)
-            current = []
-            in_layout = False
-        else:
-            current.append(line)
+    spans: List[Tuple[int, int]] = []
+    spans_append = spans.append
+    pos = 0
+    for m in LAYOUT_RE.finditer(ert_text):
+        start, end = m.span()
+        if start > pos:
+            spans_append((pos, start))
+        spans_append((start, end))
+        pos = end
 
     # any remainder
-    if current:
-        blocks.append(current)
+    if pos < len(ert_text):
+        spans.append((pos, len(ert_text)))
 
-    return blocks
-
-
-def join_layout_blocks(blocks: List[List[str]]) -> List[str]:
-    """
-    Flatten the list-of-lists back into lines.
-    """
-    out: List[str] = []
-    for b in blocks:
-        out.extend(b)
-    return out
+    return spans
 
 
 ##############################################################################
-# Step 3) Searching each layout block for environment or tikzset lines
+# Step 3) Searching the ERT for environment or tikzset lines
 ##############################################################################
 
-def has_environment(lines_block: List[str]) -> bool:
-    """Return True if the block contains a line that matches ENV_LINE_RE."""
-    text = "\n".join(lines_block)
-    return bool(ENV_LINE_RE.search(text))
-
-
-def has_tikzset(lines_block: List[str]) -> bool:
-    """Return True if lines_block has any 'tikzsetnextfilename{...}' 
-       (with possible multiline after \backslash)."""
-    text = "\n".join(lines_block)
-    match = TIKZSET_RE.search(text)
-    if not match:
-        # Extra debug: show the block if we suspect there's a command we didn't catch
-        # Uncomment if you want REALLY verbose block printing:
-        #
-        # print("      [DEBUG] has_tikzset? No match in block lines:")
-        # for ln in lines_block:
-        #     print(f"         {ln.rstrip()}")
-        pass
-    return bool(match)
-
-
-def get_tikz_indices(lines_block: List[str], prefix: str) -> List[int]:
+def find_environments(ert_text: str) -> List[int]:
+    """
+    Return the sorted offsets of every \backslash that is followed (after
+    whitespace/newlines only) by one of ENV_NAMES.
+    """
+    offsets: List[int] = []
+    offsets_append = offsets.append
+    find = ert_text.find
+    for env in ENV_NAMES:
+        idx = find(env)
+        while idx != -1:
+            # step back over any run of whitespace, like \s* in TIKZSET_RE
+            j = idx
+            while j > 0 and ert_text[j - 1].isspace():
+                j -= 1
+            if ert_text.endswith("\\backslash", 0, j):
+                offsets_append(j - len("\\backslash"))
+            idx = find(env, idx + len(env))
+    offsets.sort()
+    return offsets
+
+
+def compile_tikzset_prefix_re(prefix: str) -> Pattern[str]:
     """
-    Return all integer indices in lines_block that match:
+    Build the pattern matching:
       \backslash
       tikzsetnextfilename{<prefix><N>}
-    (with possible extra whitespace/newlines).
+    for a given prefix, with N in group 1. The prefix is escaped, so e.g.
+    'qc.pict' only matches a literal dot.
     """
-    text = "\n".join(lines_block)
-    # We just replace the prefix in the pattern:
-    pat = re.compile(
-        rf'\\backslash\s*(?:\n\s*)*tikzsetnextfilename\{{{prefix}(\d+)\}}',
-        re.DOTALL
+    return re.compile(
+        rf'\\backslash\s*tikzsetnextfilename\{{{re.escape(prefix)}(\d+)\}}'
     )
-    return [int(m.group(1)) for m in pat.finditer(text)]
+
+
+def find_max_index(data: str, ert_blocks: List[Tuple[int,int]], pat: Pattern[str]) -> int:
+    """
+    Return the largest N used by pat (see compile_tikzset_prefix_re()) in any
+    of the ERT regions of data, or 0. Block boundaries don't matter here, so
+    each region is searched in place without splitting or slicing it.
+    """
+    return max((int(m.group(1))
+                for (start, end) in ert_blocks
+                for m in pat.finditer(data, start, end)),
+               default=0)
+
+
+def scan_ert(ert_text: str) -> Tuple[List[Tuple[int, int]], List[bool], List[bool]]:
+    """
+    Split ERT into layout block spans, then search the whole ERT text once for
+    environments and once with TIKZSET_RE, bucketing each hit into the span
+    it starts in.
+
+    Return (spans, env_flags, tikz_flags) where env_flags[i] and
+    tikz_flags[i] tell whether spans[i] has an environment / a tikzset.
+    """
+    spans = split_into_layout_spans(ert_text)
+    env_flags = [False] * len(spans)
+    tikz_flags = [False] * len(spans)
+    # hits and spans are both sorted, so just walk forward
+    k = 0
+    for offset in find_environments(ert_text):
+        while spans[k][1] <= offset:
+            k += 1
+        env_flags[k] = True
+    k = 0
+    for m in TIKZSET_RE.finditer(ert_text):
+        while spans[k][1] <= m.start():
+            k += 1
+        tikz_flags[k] = True
+    return (spans, env_flags, tikz_flags)
 
 
 ##############################################################################
 # Step 4) Insert a new layout block with tikzset if needed
 ##############################################################################
 
-def make_tikz_layout(prefix: str, idx: int) -> List[str]:
+TIKZ_TEMPLATE = (
+    "\\begin_layout Plain Layout\n"
+    "\\backslash\n"
+    "tikzsetnextfilename{%s%d}\n"
+    "\\end_layout\n"
+)
+
+
+def make_tikz_layout(prefix: str, idx: int) -> str:
     """
-    Return lines for:
+    Return the text for:
       \begin_layout Plain Layout
       \backslash
       tikzsetnextfilename{prefixN}
       \end_layout
     """
-    return [
-        r"\begin_layout Plain Layout" + "\n",
-        r"\backslash" + "\n",
-        f"tikzsetnextfilename{{{prefix}{idx}}}\n",
-        r"\end_layout" + "\n"
-    ]
+    return TIKZ_TEMPLATE % (prefix, idx)
 
 
-def insert_tikz_in_ert(ert_lines: List[str], prefix: str, start_idx: int) -> Tuple[List[str], int]:
+def insert_tikz_in_ert(ert_text: str, spans: List[Tuple[int, int]],
+                       env_flags: List[bool], tikz_flags: List[bool],
+                       prefix: str, start_idx: int,
+                       debug: bool = False) -> Tuple[str, int]:
     """
-    Split ERT into layout blocks, then for each block that has an environment,
-    check if it or the block above has 'tikzsetnextfilename'.
-    If not, insert a new layout block above it.
+    Given the layout block spans and flags from scan_ert(), for each block
+    that has an environment, check if it or the block above has
+    'tikzsetnextfilename'. If not, insert a new layout block above it.
 
-    Return (new ERT lines, updated next_index).
+    Return (new ERT text, updated next_index).
     """
-    blocks = split_into_layout_blocks(ert_lines)
-    i = 0
+    dbg = debug_print if debug else no_debug
+    pieces: List[str] = []
+    pieces_append = pieces.append
     current_index = start_idx
+    copied = 0
+    prev_tikzset = False
 
-    print(f"  [DEBUG] ERT block has {len(blocks)} layout blocks.")
-    while i < len(blocks):
-        block = blocks[i]
-        # debug
-        text_head = (block[0].strip() if block else "")
-        print(f"    [DEBUG] LayoutBlock #{i}: first line='{text_head}'")
+    dbg("  [DEBUG] ERT block has %d layout blocks.", len(spans))
+    for i, (start, end) in enumerate(spans):
+        if debug:
+            text_head = ert_text[start:end].split("\n", 1)[0].strip()
+            dbg("    [DEBUG] LayoutBlock #%d: first line='%s'", i, text_head)
 
-        if has_environment(block):
-            print(f"    [DEBUG] -> Found environment in layout block #{i}.")
+        if env_flags[i]:
+            dbg("    [DEBUG] -> Found environment in layout block #%d.", i)
             # check if this block or previous block has tikzset
-            if has_tikzset(block):
-                print(f"    [DEBUG] -> Already has tikzset in same block. Skipping insertion.")
+            if tikz_flags[i]:
+                dbg("    [DEBUG] -> Already has tikzset in same block. Skipping insertion.")
+            elif prev_tikzset:
+                dbg("    [DEBUG] -> Found tikzset in previous block. Skipping insertion.")
             else:
-                if i > 0 and has_tikzset(blocks[i - 1]):
-                    print(f"    [DEBUG] -> Found tikzset in previous block. Skipping insertion.")
-                else:
-                    print(f"    [DEBUG] -> Inserting new layout block with tikzset for index {current_index}")
-                    new_block = make_tikz_layout(prefix, current_index)
-                    blocks.insert(i, new_block)
-                    current_index += 1
-                    i += 1
-        i += 1
+                dbg("    [DEBUG] -> Inserting new layout block with tikzset for index %d", current_index)
+                # everything up to this block is unchanged
+                pieces_append(ert_text[copied:start])
+                pieces_append(make_tikz_layout(prefix, current_index))
+                copied = start
+                current_index += 1
+        # the block above the next one is this original block, not any
+        # tikzset layout we just put in front of it
+        prev_tikzset = tikz_flags[i]
 
-    return (join_layout_blocks(blocks), current_index)
+    pieces_append(ert_text[copied:])
+    return ("".join(pieces), current_index)
 
 
 ##############################################################################
 # Step 5) Main flow
 ##############################################################################
 
-def main():
-    args = parse_arguments()
+def process_file(path: str, prefix: str, prefix_re: Pattern[str], start_index: int,
+                 yes: bool = False, debug: bool = False) -> bool:
+    """
+    Number the tikz environments of one .lyx file in place. prefix_re is
+    compile_tikzset_prefix_re(prefix), built once by the caller.
+
+    Return False if the file could not be read, True otherwise (including
+    when there was nothing to do or the user declined).
+    """
+    dbg = debug_print if debug else no_debug
 
-    # read lines
+    # read the whole file at once; everything below works on offsets into it
     try:
-        with open(args.file, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+        with open(path, "r", encoding="utf-8") as f:
+            data = f.read()
     except FileNotFoundError:
-        print(f"Error: file not found: {args.file}")
-        sys.exit(1)
+        print(f"Error: file not found: {path}")
+        return False
 
-    # find ERT blocks
-    ert_blocks = find_ert_blocks(lines)
+    # find ERT blocks; documents without any ERT at all are common, and a
+    # single substring test rules them out before any parsing
+    ert_blocks = find_ert_blocks(data) if "\\begin_inset ERT" in data else []
     if not ert_blocks:
         print("No ERT blocks found. Nothing to do.")
-        sys.exit(0)
+        return True
 
     print(f"Found {len(ert_blocks)} ERT blocks.")
 
-    # find existing max index
-    max_found = 0
-    for (start_i, end_i) in ert_blocks:
-        block_lines = lines[start_i:end_i+1]
-        # parse layout blocks
-        lb = split_into_layout_blocks(block_lines)
-        for subblock in lb:
-            used_nums = get_tikz_indices(subblock, args.prefix)
-            if used_nums:
-                max_found = max(max_found, max(used_nums))
-
-    start_val = max(args.start_index, max_found + 1)
+    # find existing max index; the layout blocks are only needed once we
+    # actually insert, so nothing is split before the prompt
+    max_found = find_max_index(data, ert_blocks, prefix_re)
+
+    start_val = max(start_index, max_found + 1)
     print(f"Existing maximum found: {max_found}")
     print(f"Starting new numbering from: {start_val}")
-    proceed = input("Proceed? [y/n]: ").strip().lower()
-    if proceed not in ("y", "yes"):
-        print("Aborted.")
-        sys.exit(0)
+    if not yes:
+        proceed = input("Proceed? [y/n]: ").strip().lower()
+        if proceed not in ("y", "yes"):
+            print("Aborted.")
+            return True
 
-    new_lines: List[str] = []
-    prev_end = -1
+    prev_end = 0
     next_index = start_val
 
-    # process each ERT
-    for i, (start_i, end_i) in enumerate(ert_blocks):
-        print(f"[DEBUG] Processing ERT block #{i} (lines {start_i}-{end_i})")
+    # stream the result into a temp file next to the real (symlink-resolved)
+    # file, then swap it in atomically with the original's permissions; no
+    # second full copy of the document is kept in memory
+    real = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(real),
+                                    prefix=os.path.basename(real) + ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as out:
+            # process each ERT
+            for i, (start, end) in enumerate(ert_blocks):
+                dbg("[DEBUG] Processing ERT block #%d (chars %d-%d)", i, start, end)
+
+                # copy everything prior to this block
+                out.write(data[prev_end:start])
+
+                # do insertion
+                ert_text = data[start:end]
+                spans, env_flags, tikz_flags = scan_ert(ert_text)
+                modified_ert, updated_idx = insert_tikz_in_ert(ert_text, spans, env_flags, tikz_flags,
+                                                               prefix, next_index, debug)
+                next_index = updated_idx
+
+                out.write(modified_ert)
+                prev_end = end
+
+            # copy tail
+            out.write(data[prev_end:])
+
+        shutil.copymode(real, tmp_path)
+        os.replace(tmp_path, real)
+    finally:
+        # only still there if something above failed
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
 
-        # copy everything prior to this block
-        new_lines.extend(lines[prev_end+1:start_i])
-        ert_content = lines[start_i:end_i+1]
+    print(f"]Done. Final index used: {next_index - 1}.")
+    return True
 
-        # do insertion
-        modified_ert, updated_idx = insert_tikz_in_ert(ert_content, args.prefix, next_index)
-        next_index = updated_idx
 
-        new_lines.extend(modified_ert)
-        prev_end = end_i
+def process_file_quiet(path: str, prefix: str, prefix_re: Pattern[str], start_index: int,
+                       debug: bool = False) -> Tuple[bool, str]:
+    """
+    Worker-side process_file() for parallel runs (implies --yes).
+    Captures everything it would print and returns (ok, output), so the
+    parent can print each file's report in order instead of interleaving.
+    """
+    buf = io.StringIO()
+    with contextlib.redirect_stdout(buf):
+        ok = process_file(path, prefix, prefix_re, start_index, yes=True, debug=debug)
+    return (ok, buf.getvalue())
 
-    # copy tail
-    if ert_blocks:
-        last_end = ert_blocks[-1][1]
-        new_lines.extend(lines[last_end+1:])
 
-    # write
-    with open(args.file, "w", encoding="utf-8") as f:
-        f.writelines(new_lines)
+def file_key(path: str) -> Tuple[object, ...]:
+    """
+    Identify the file behind path, so that duplicates given on the command
+    line (the same name twice, a symlink, a hard link) compare equal.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (os.path.realpath(path),)
+    return (st.st_dev, st.st_ino)
 
-    print(f"]Done. Final index used: {next_index - 1}.")
+
+def main() -> None:
+    args = parse_arguments()
+    paths = args.file
+
+    # compile the per-prefix pattern once for all files (it pickles fine,
+    # so the worker processes get it as is)
+    prefix_re = compile_tikzset_prefix_re(args.prefix)
+
+    # one interpreter for all files; each file is numbered on its own
+    ok = True
+    if args.yes and len(paths) > 1:
+        # files are independent and nothing prompts, so spread them over
+        # cores; but two workers must never rewrite the same file at once
+        first: List[int] = []  # index of the first path naming the same file
+        first_by_key: Dict[Tuple[object, ...], int] = {}
+        for i, path in enumerate(paths):
+            first.append(first_by_key.setdefault(file_key(path), i))
+
+        n = len(first_by_key)
+        with ProcessPoolExecutor(max_workers=min(n, os.cpu_count() or 1)) as ex:
+            futures = {i: ex.submit(process_file_quiet, paths[i], args.prefix,
+                                    prefix_re, args.start_index, args.debug)
+                       for i in first_by_key.values()}
+            # report in command-line order; one failing file only spoils
+            # its own section
+            for i, path in enumerate(paths):
+                print(f"=== {path} ===")
+                if first[i] != i:
+                    print(f"Skipped: same file as {paths[first[i]]}.")
+                    continue
+                try:
+                    file_ok, output = futures[i].result()
+                except Exception as exc:
+                    print(f"Error: {path}: {exc}")
+                    ok = False
+                    continue
+                print(output, end="")
+                ok = file_ok and ok
+    else:
+        for path in paths:
+            if len(paths) > 1:
+                print(f"=== {path} ===")
+            ok = process_file(path, args.prefix, prefix_re, args.start_index,
+                              args.yes, args.debug) and ok
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == "__main__":